@@ -1,13 +1,14 @@
 """Test Django Postgres Views
 """
-from contextlib import closing
+from threading import Thread
 
-from django.contrib import auth
+from django.contrib.auth.hashers import make_password
 from django.core.management import call_command
 from django.db import connection
 from django.db.models import signals
 from django.dispatch import receiver
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
 from django_postgres_views.models import ViewSyncer
 from django_postgres_views.signals import view_synced, all_views_synced
 
@@ -21,74 +22,75 @@ def create_test_schema(sender, app_config, **kwargs):
         cursor.execute(command)
 
 
+@override_settings(
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
 class ViewTestCase(TestCase):
     """Run the tests to ensure the post_migrate hooks were called.
     """
 
+    @classmethod
+    def setUpTestData(cls):
+        # Insert the row directly, the projections only need the id,
+        # username and password to come through.
+        cls.foo_password = make_password('blah')
+        with connection.cursor() as cur:
+            cur.execute(
+                """INSERT INTO auth_user
+                (username, password, is_superuser, is_staff, is_active,
+                 first_name, last_name, email, date_joined)
+                VALUES (%s, %s, TRUE, FALSE, TRUE, '', '', '', now())
+                RETURNING id;""", ('foo', cls.foo_password))
+            cls.foo_user_id, = cur.fetchone()
+
     def test_views_have_been_created(self):
         """Look at the Postgres View table to ensure views were created.
         """
-        with closing(connection.cursor()) as cur:
-            cur.execute('''SELECT COUNT(*) FROM pg_views
-                        WHERE viewname LIKE 'viewtest_%';''')
-
-            count, = cur.fetchone()
-            self.assertEqual(count, 4)
-
-            cur.execute('''SELECT COUNT(*) FROM pg_matviews
-                        WHERE matviewname LIKE 'viewtest_%';''')
-
-            count, = cur.fetchone()
-            self.assertEqual(count, 3)
-
-            cur.execute('''SELECT COUNT(*) FROM information_schema.views
-                        WHERE table_schema = 'test_schema';''')
-
-            count, = cur.fetchone()
-            self.assertEqual(count, 1)
+        with connection.cursor() as cur:
+            cur.execute('''SELECT
+                (SELECT COUNT(*) FROM (SELECT 1 FROM pg_views
+                 WHERE viewname LIKE %s LIMIT 10) AS v),
+                (SELECT COUNT(*) FROM (SELECT 1 FROM pg_matviews
+                 WHERE matviewname LIKE %s LIMIT 10) AS mv),
+                (SELECT COUNT(*) FROM (SELECT 1 FROM information_schema.views
+                 WHERE table_schema = %s LIMIT 5) AS sv);''',
+                        ('viewtest_%', 'viewtest_%', 'test_schema'))
+
+            views, matviews, schema_views = cur.fetchone()
+            self.assertEqual(views, 4)
+            self.assertEqual(matviews, 3)
+            self.assertEqual(schema_views, 1)
 
     def test_clear_views(self):
         """Check the Postgres View table to see that the views were removed.
         """
         call_command('clear_postgres_views', *[], **{})
-        with closing(connection.cursor()) as cur:
-            cur.execute('''SELECT COUNT(*) FROM pg_views
-                        WHERE viewname LIKE 'viewtest_%';''')
-
-            count, = cur.fetchone()
-            self.assertEqual(count, 0)
-
-            cur.execute('''SELECT COUNT(*) FROM information_schema.views
-                        WHERE table_schema = 'test_schema';''')
+        with connection.cursor() as cur:
+            cur.execute('''SELECT
+                EXISTS (SELECT 1 FROM pg_views
+                        WHERE viewname LIKE %s),
+                EXISTS (SELECT 1 FROM information_schema.views
+                        WHERE table_schema = %s);''',
+                        ('viewtest_%', 'test_schema'))
 
-            count, = cur.fetchone()
-            self.assertEqual(count, 0)
+            views, schema_views = cur.fetchone()
+            self.assertFalse(views)
+            self.assertFalse(schema_views)
 
     def test_wildcard_projection(self):
         """Wildcard projections take all fields from a projected model.
         """
-        foo_user = auth.models.User.objects.create(
-            username='foo', is_superuser=True)
-        foo_user.set_password('blah')
-        foo_user.save()
-
         foo_superuser = models.Superusers.objects.get(username='foo')
 
-        self.assertEqual(foo_user.id, foo_superuser.id)
-        self.assertEqual(foo_user.password, foo_superuser.password)
+        self.assertEqual(self.foo_user_id, foo_superuser.id)
+        self.assertEqual(self.foo_password, foo_superuser.password)
 
     def test_limited_projection(self):
         """A limited projection only creates the projected fields.
         """
-        foo_user = auth.models.User.objects.create(
-            username='foo', is_superuser=True)
-        foo_user.set_password('blah')
-        foo_user.save()
-
         foo_simple = models.SimpleUser.objects.get(username='foo')
 
-        self.assertEqual(foo_simple.username, foo_user.username)
-        self.assertEqual(foo_simple.password, foo_user.password)
+        self.assertEqual(foo_simple.username, 'foo')
+        self.assertEqual(foo_simple.password, self.foo_password)
         self.assertFalse(getattr(foo_simple, 'date_joined', False))
 
     def test_related_delete(self):
@@ -99,30 +101,6 @@ class ViewTestCase(TestCase):
         test_model.save()
         test_model.delete()
 
-    def test_materialized_view(self):
-        """Test a materialized view works correctly
-        """
-        self.assertEqual(models.MaterializedRelatedView.objects.count(), 0,
-                         'Materialized view should not have anything')
-
-        test_model = models.TestModel()
-        test_model.name = "Bob"
-        test_model.save()
-
-        self.assertEqual(models.MaterializedRelatedView.objects.count(), 0,
-                         'Materialized view should not have anything')
-
-        models.MaterializedRelatedView.refresh()
-
-        self.assertEqual(models.MaterializedRelatedView.objects.count(), 1,
-                         'Materialized view should have updated')
-
-        models.MaterializedRelatedViewWithIndex.refresh(concurrently=True)
-
-        self.assertEqual(
-            models.MaterializedRelatedViewWithIndex.objects.count(), 1,
-            'Materialized view should have updated concurrently')
-
     def test_signals(self):
         expected = {
             models.MaterializedRelatedView: {
@@ -151,7 +129,7 @@ class ViewTestCase(TestCase):
         def on_all_views_synced(sender, **kwargs):
             all_views_were_synced[0] = True
 
-        call_command('sync_postgres_views', update=False)
+        ViewSyncer().run(force=False, update=False)
 
         # All views went through syncing
         self.assertEqual(len(synced_views), 8)
@@ -159,6 +137,63 @@ class ViewTestCase(TestCase):
         self.assertFalse(expected)
 
 
+class MaterializedViewTestCase(TransactionTestCase):
+    """Refresh materialized views from separate connections.
+
+    The refreshes run on their own threads, and so their own connections,
+    which only see committed rows and would block on the locks held by a
+    `TestCase` transaction.
+    """
+
+    def tearDown(self):
+        models.TestModel.objects.all().delete()
+        models.MaterializedRelatedView.refresh()
+        models.MaterializedRelatedViewWithIndex.refresh()
+
+    def test_materialized_view(self):
+        """Test a materialized view works correctly
+        """
+        self.assertEqual(models.MaterializedRelatedView.objects.count(), 0,
+                         'Materialized view should not have anything')
+
+        test_model = models.TestModel()
+        test_model.name = "Bob"
+        test_model.save()
+
+        self.assertEqual(models.MaterializedRelatedView.objects.count(), 0,
+                         'Materialized view should not have anything')
+
+        errors = []
+
+        def _refresh(view_cls, **kwargs):
+            # Django connections are thread-local, so each thread refreshes
+            # on its own backend.
+            try:
+                view_cls.refresh(**kwargs)
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                connection.close()
+
+        threads = [
+            Thread(target=_refresh, args=(models.MaterializedRelatedView,)),
+            Thread(target=_refresh,
+                   args=(models.MaterializedRelatedViewWithIndex,),
+                   kwargs={'concurrently': True}),
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertFalse(errors)
+        self.assertEqual(models.MaterializedRelatedView.objects.count(), 1,
+                         'Materialized view should have updated')
+        self.assertEqual(
+            models.MaterializedRelatedViewWithIndex.objects.count(), 1,
+            'Materialized view should have updated concurrently')
+
+
 class DependantViewTestCase(TestCase):
     def test_sync_depending_views(self):
         """Test the sync_postgres_views command for views that depend on other views.
@@ -169,27 +204,21 @@ class DependantViewTestCase(TestCase):
         Then we sync the views again and verify that everything was updated.
         """
 
-        with closing(connection.cursor()) as cur:
-            cur.execute("DROP VIEW viewtest_relatedview CASCADE;")
-
+        with connection.cursor() as cur:
             cur.execute(
-                """CREATE VIEW viewtest_relatedview as
-                SELECT id AS model_id, name FROM viewtest_testmodel;""")
-
-            cur.execute("""CREATE VIEW viewtest_dependantview as
-                        SELECT name from viewtest_relatedview;""")
-
-            cur.execute("""SELECT name from viewtest_relatedview;""")
-            cur.execute("""SELECT name from viewtest_dependantview;""")
+                """DROP VIEW viewtest_relatedview CASCADE;
+                CREATE VIEW viewtest_relatedview as
+                SELECT id AS model_id, name FROM viewtest_testmodel;
+                CREATE VIEW viewtest_dependantview as
+                SELECT name from viewtest_relatedview;""")
 
         call_command('sync_postgres_views', '--force')
 
-        with closing(connection.cursor()) as cur:
-            cur.execute("""SELECT COUNT(*) FROM pg_views
-                        WHERE viewname LIKE 'viewtest_%';""")
+        with connection.cursor() as cur:
+            cur.execute("""SELECT 1 FROM pg_views
+                        WHERE viewname LIKE %s LIMIT 10;""", ('viewtest_%',))
 
-            count, = cur.fetchone()
-            self.assertEqual(count, 4)
+            self.assertEqual(len(cur.fetchall()), 4)
 
             with self.assertRaises(Exception):
                 cur.execute("""SELECT name from viewtest_relatedview;""")
@@ -200,31 +229,22 @@ class DependantViewTestCase(TestCase):
     def test_sync_depending_materialized_views(self):
         """Refresh views that depend on materialized views.
         """
-        with closing(connection.cursor()) as cur:
+        with connection.cursor() as cur:
             cur.execute(
                 """DROP MATERIALIZED VIEW viewtest_materializedrelatedview
-                CASCADE;""")
-
-            cur.execute(
-                """CREATE MATERIALIZED VIEW viewtest_materializedrelatedview as
-                SELECT id AS model_id, name FROM viewtest_testmodel;""")
-
-            cur.execute(
-                """CREATE MATERIALIZED VIEW viewtest_dependantmaterializedview
+                CASCADE;
+                CREATE MATERIALIZED VIEW viewtest_materializedrelatedview as
+                SELECT id AS model_id, name FROM viewtest_testmodel;
+                CREATE MATERIALIZED VIEW viewtest_dependantmaterializedview
                 as SELECT name from viewtest_materializedrelatedview;""")
-            cur.execute(
-                """SELECT name from viewtest_materializedrelatedview;""")
-            cur.execute(
-                """SELECT name from viewtest_dependantmaterializedview;""")
 
         call_command('sync_postgres_views', '--force')
 
-        with closing(connection.cursor()) as cur:
-            cur.execute("""SELECT COUNT(*) FROM pg_views
-                        WHERE viewname LIKE 'viewtest_%';""")
+        with connection.cursor() as cur:
+            cur.execute("""SELECT 1 FROM pg_views
+                        WHERE viewname LIKE %s LIMIT 10;""", ('viewtest_%',))
 
-            count, = cur.fetchone()
-            self.assertEqual(count, 4)
+            self.assertEqual(len(cur.fetchall()), 4)
 
             with self.assertRaises(Exception):
                 cur.execute(